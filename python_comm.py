@@ -1,7 +1,12 @@
-import re
+import functools
+import itertools
+import os
 import serial
+import serial.tools.list_ports
+import sys
 import time
 import asyncio
+import numpy as np
 import pandas as pd
 
 HANDSHAKE = 0
@@ -10,6 +15,18 @@ ON_REQUEST = 2
 STREAM = 3
 READ_DAQ_DELAY = 4
 
+# Bytes stripped when parsing reads: everything but digits, commas,
+# and newlines
+_DELETE_BYTES = bytes(b for b in range(256) if b not in b"0123456789,\n")
+
+# Longest field in a valid row, an unsigned long; anything longer comes
+# from rows that ran together and would overflow int64
+_MAX_DIGITS = 10
+
+# Counts per volt of the Arduino's 10-bit, 5 V ADC
+_COUNTS_PER_VOLT = np.float32(1023 / 5)
+
+
 def find_arduino(port=None):
     """Get the name of the port that is connected to Arduino."""
     if port is None:
@@ -29,8 +46,11 @@ def handshake_arduino(
     arduino.close()
     arduino.open()
 
-    # Chill out while everything gets set
-    time.sleep(sleep_time)
+    # Chill out while everything gets set, moving on early if the
+    # Arduino starts talking
+    start = time.monotonic()
+    while time.monotonic() - start < sleep_time and arduino.in_waiting == 0:
+        time.sleep(0.01)
 
     # Set a long timeout to complete handshake
     timeout = arduino.timeout
@@ -45,9 +65,10 @@ def handshake_arduino(
     # Read in what Arduino sent
     handshake_message = arduino.read_until()
 
-    # Send and receive request again
-    arduino.write(bytes([handshake_code]))
-    handshake_message = arduino.read_until()
+    # Only ask again if nothing came back, e.g. Arduino was still booting
+    if not handshake_message:
+        arduino.write(bytes([handshake_code]))
+        handshake_message = arduino.read_until()
 
     # Print the handshake message, if desired
     if print_handshake_message:
@@ -57,6 +78,19 @@ def handshake_arduino(
     arduino.timeout = timeout
 
 
+def set_low_latency(arduino, latency_timer=1):
+    """Keep the host from holding back serial data, where possible."""
+    # FTDI adapters on Linux batch incoming data for `latency_timer`
+    # milliseconds (16 by default); other chipsets do not have this file
+    if sys.platform.startswith("linux"):
+        device = os.path.basename(arduino.port)
+        try:
+            with open(f"/sys/bus/usb-serial/devices/{device}/latency_timer", "w") as f:
+                f.write(str(latency_timer))
+        except OSError:
+            pass
+
+
 def read_all(ser, read_buffer=b"", **args):
     """Read all available bytes from the serial port
     and append to the read buffer.
@@ -79,17 +113,13 @@ def read_all(ser, read_buffer=b"", **args):
        compatibility with `read_all_newlines()` as a
        drop-in replacement for this function.
     """
-    # Set timeout to None to make sure we read all bytes
-    previous_timeout = ser.timeout
-    ser.timeout = None
-
+    # Everything in waiting is already buffered, so the read returns
+    # immediately regardless of the timeout
     in_waiting = ser.in_waiting
-    read = ser.read(size=in_waiting)
-
-    # Reset to previous timeout
-    ser.timeout = previous_timeout
+    if in_waiting == 0:
+        return read_buffer
 
-    return read_buffer + read
+    return read_buffer + ser.read(size=in_waiting)
 
 
 def read_all_newlines(ser, read_buffer=b"", n_reads=4):
@@ -120,7 +150,7 @@ def read_all_newlines(ser, read_buffer=b"", n_reads=4):
     return raw
 
 
-def parse_read(read):
+def parse_read(read, counts_per_unit=_COUNTS_PER_VOLT):
     """Parse a read with time, volage data
 
     Parameters
@@ -128,38 +158,55 @@ def parse_read(read):
     read : byte string
         Byte string with comma delimited time/voltage
         measurements.
+    counts_per_unit : float, default 1023 / 5
+        Number of counts per unit of the measured value. Digits
+        are read as counts once stray bytes, including any decimal
+        point, are stripped. The default converts ADC counts to volts.
 
     Returns
     -------
-    time_ms : list of ints
+    time_ms : array of ints
         Time points in milliseconds.
-    voltage : list of floats
-        Voltages in volts.
+    voltage : array of floats
+        Voltages in volts, or values in the units set by
+        `counts_per_unit`.
     remaining_bytes : byte string
         Remaining, unparsed bytes.
     """
-    time_ms = []
-    voltage = []
+    # Only rows terminated by \r\n are complete; hold on to the rest
+    # for the next read
+    end = read.rfind(b"\r\n")
+    if end < 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), read
+    remaining_bytes = read[end + 2 :]
+
+    # Strip stray bytes from all complete rows in one pass, keeping the
+    # newlines that separate them
+    rows = read[:end].translate(None, _DELETE_BYTES)
+
+    # Every complete row has a comma, so this bounds the number of rows
+    n = rows.count(b",")
+    time_ms = np.empty(n, dtype=np.int64)
+    raw_voltage = np.empty(n, dtype=np.int64)
 
-    # Separate independent time/voltage measurements
-    pattern = re.compile(b"\d+|,")
-    raw_list = [
-        b"".join(pattern.findall(raw)).decode()
-        for raw in read.split(b"\r\n")
-    ]
+    i = 0
+    for row in rows.split(b"\n"):
+        t, _, V = row.partition(b",")
 
-    for raw in raw_list[:-1]:
-        try:
-            t, V = raw.split(",")
-            time_ms.append(int(t))
-            voltage.append(int(V) * 5 / 1023)
-        except:
-            pass
+        # Skip partial and garbled rows
+        if not (t.isdigit() and V.isdigit()):
+            continue
+        if len(t) > _MAX_DIGITS or len(V) > _MAX_DIGITS:
+            continue
+
+        time_ms[i] = int(t)
+        raw_voltage[i] = int(V)
+        i += 1
+
+    time_ms = time_ms[:i]
+    voltage = np.divide(raw_voltage[:i], counts_per_unit, dtype=np.float32)
 
-    if len(raw_list) == 0:
-        return time_ms, voltage, b""
-    else:
-        return time_ms, voltage, raw_list[-1].encode()
+    return time_ms, voltage, remaining_bytes
 
 
 async def daq_stream_async(
@@ -172,7 +219,41 @@ async def daq_stream_async(
     reader=read_all_newlines,
 ):
     """Obtain `n_data` data points from an Arduino stream
-    with a delay of `delay` milliseconds between each."""
+    with a delay of `delay` milliseconds between each.
+
+    Parameters
+    ----------
+    arduino : serial.Serial() instance
+        The device we are reading from.
+    data : dict
+        Dictionary with lists under "time_ms" and "voltage" that
+        streamed data are appended to.
+    n_data : int, default 100
+        Number of data points to acquire.
+    delay : int, default 20
+        Delay between data points in milliseconds.
+    n_trash_reads : int, default 5
+        Number of reads thrown out at the start of the stream.
+    n_reads_per_chunk : int, default 4
+        Number of newline-terminated reads per chunk. Only used on
+        non-POSIX systems; see Notes.
+    reader : function, default read_all_newlines
+        Function used to read in a chunk. Only used on non-POSIX
+        systems; see Notes.
+
+    Returns
+    -------
+    output : pandas DataFrame
+        The first `n_data` time points and voltages.
+
+    Notes
+    -----
+    .. On POSIX systems, data are read with `read_all()` as soon as
+       the port has bytes waiting, and `reader` and
+       `n_reads_per_chunk` are ignored. Elsewhere, `reader` is run
+       in a worker thread so its blocking reads do not stall the
+       event loop.
+    """
     # Specify delay
     arduino.write(bytes([READ_DAQ_DELAY]) + (str(delay) + "x").encode())
 
@@ -185,28 +266,55 @@ async def daq_stream_async(
         _ = arduino.read_until()
         i += 1
 
+    # Have the event loop tell us when the port is readable, if it can
+    loop = asyncio.get_running_loop()
+    readable = None
+    if os.name == "posix":
+        readable = asyncio.Event()
+        loop.add_reader(arduino.fileno(), readable.set)
+
     # Receive data
     read_buffer = [b""]
-    while len(data["time_ms"]) < n_data:
-        # Read in chunk of data
-        raw = reader(arduino, read_buffer=read_buffer[0], n_reads=n_reads_per_chunk)
-
-        # Parse it, passing if it is gibberish
-        try:
-            t, V, read_buffer[0] = parse_read(raw)
-
-            # Update data dictionary
-            data["time_ms"] += t
-            data["voltage"] += V
-        except:
-            pass
-
-        # Sleep 80% of the time before we need to start reading chunks
-        await asyncio.sleep(0.8 * n_reads_per_chunk * delay / 1000)
+    try:
+        while len(data["time_ms"]) < n_data:
+            # Read in chunk of data
+            if readable is not None:
+                await readable.wait()
+                readable.clear()
+                raw = read_all(arduino, read_buffer=read_buffer[0])
+            else:
+                raw = await loop.run_in_executor(
+                    None,
+                    functools.partial(
+                        reader,
+                        arduino,
+                        read_buffer=read_buffer[0],
+                        n_reads=n_reads_per_chunk,
+                    ),
+                )
+
+            # Parse it, passing if it is gibberish
+            try:
+                t, V, read_buffer[0] = parse_read(raw)
+
+                # Update data dictionary
+                data["time_ms"].extend(t.tolist())
+                data["voltage"].extend(V.tolist())
+            except:
+                pass
+    finally:
+        if readable is not None:
+            loop.remove_reader(arduino.fileno())
 
     # Turn off the stream
     arduino.write(bytes([ON_REQUEST]))
 
-    return pd.DataFrame(
-        {"time (ms)": data["time_ms"][:n_data], "voltage (V)": data["voltage"][:n_data]}
-    )
\ No newline at end of file
+    # Build arrays straight from the first n_data points, without slicing
+    time_ms = np.fromiter(
+        itertools.islice(data["time_ms"], n_data), dtype=np.int64, count=n_data
+    )
+    voltage = np.fromiter(
+        itertools.islice(data["voltage"], n_data), dtype=np.float32, count=n_data
+    )
+
+    return pd.DataFrame({"time (ms)": time_ms, "voltage (V)": voltage})
@@ -9,7 +9,6 @@ on the command line.
 """
 
 import asyncio
-import re
 import sys
 import time
 import os
@@ -18,206 +17,121 @@ import numpy as np
 import pandas as pd
 
 import serial
-import serial.tools.list_ports
+import serial_asyncio
 
 import bokeh.plotting
 import bokeh.io
 import bokeh.layouts
 import bokeh.driving
 
-
-# Set up data dictionaries
-stream_data = dict(prev_array_length=0, t=[], A=[], mode="on demand")
+from python_comm import find_arduino, handshake_arduino, set_low_latency, parse_read
+
+
+# Number of points shown on the plots
+rollover = 400
+
+# Set up data dictionaries; streaming data for the plot go into ring
+# buffers one plot wide, with write_idx and read_idx counting the points
+# written and plotted so far, and last_flush_t the time the plot was last
+# updated. Every point is also written at index write_idx of t_history
+# and A_history, which grow as needed, so that saving gets the whole
+# stream, not just what is left in the ring buffers.
+stream_data = dict(
+    t=np.empty(rollover, dtype=np.int64),
+    A=np.empty(rollover, dtype=np.float32),
+    write_idx=0,
+    read_idx=0,
+    last_flush_t=0.0,
+    t_history=np.empty(rollover, dtype=np.int64),
+    A_history=np.empty(rollover, dtype=np.float32),
+    mode="on demand",
+)
 on_demand_data = dict(t=[], A=[])
 
 current_dir = os.getcwd()
 data_path = os.path.join(current_dir, "Data")
 
 
-def find_arduino(port=None):
-    """Get the name of the port that is connected to Arduino."""
-    if port is None:
-        ports = serial.tools.list_ports.comports()
-        for p in ports:
-            if p.manufacturer is not None and "Arduino" in p.manufacturer:
-                port = p.device
-    return port
+# Set up connection
+HANDSHAKE = 0
+ABSORBANCE_REQUEST = 1
+ON_REQUEST = 2
+STREAM = 3
+READ_DAQ_DELAY = 4
 
+port = find_arduino()
+arduino = serial.Serial(port, baudrate=115200)
+handshake_arduino(arduino)
+set_low_latency(arduino)
 
-def handshake_arduino(
-    arduino, sleep_time=1, print_handshake_message=False, handshake_code=0
-):
-    """Make sure connection is established by sending
-    and receiving bytes."""
-    # Close and reopen
-    arduino.close()
-    arduino.open()
+# Counts per unit absorbance, once the decimal point is stripped from
+# the three-decimal values sent by the Arduino; dividing by it keeps
+# values like 0.005 exact in float32, where multiplying by 1e-3 does not
+_ABSORBANCE_COUNTS = np.float32(1000)
 
-    # Chill out while everything gets set
-    time.sleep(sleep_time)
 
-    # Set a long timeout to complete handshake
-    timeout = arduino.timeout
-    arduino.timeout = 2
+def ring_write(buf, start, values):
+    """Write `values` into ring buffer `buf`, where `start` is the
+    total number of points written to it so far."""
+    capacity = len(buf)
+    n = len(values)
 
-    # Read and discard everything that may be in the input buffer
-    _ = arduino.read_all()
+    # Only the last `capacity` values survive
+    if n > capacity:
+        start += n - capacity
+        values = values[-capacity:]
+        n = capacity
 
-    # Send request to Arduino
-    arduino.write(bytes([handshake_code]))
+    # Write up to the end of the buffer, then wrap around
+    i = start % capacity
+    n_first = min(n, capacity - i)
+    buf[i : i + n_first] = values[:n_first]
+    buf[: n - n_first] = values[n_first:]
 
-    # Read in what Arduino sent
-    handshake_message = arduino.read_until()
 
-    # Send and receive request again
-    arduino.write(bytes([handshake_code]))
-    handshake_message = arduino.read_until()
+def ring_segments(buf, start, stop):
+    """Views of the (at most two) stretches of ring buffer `buf` that
+    hold points `start` through `stop - 1`, counted in total points
+    written. Points that have already been overwritten are skipped."""
+    capacity = len(buf)
+    start = max(start, stop - capacity)
 
-    # Print the handshake message, if desired
-    if print_handshake_message:
-        print("Handshake message: " + handshake_message.decode())
+    if start >= stop:
+        return buf[:0], buf[:0]
 
-    # Reset the timeout
-    arduino.timeout = timeout
+    # Read up to the end of the buffer, then wrap around
+    i = start % capacity
+    n_first = min(stop - start, capacity - i)
+    return buf[i : i + n_first], buf[: stop - start - n_first]
 
-# Set up connection
-HANDSHAKE = 0
-ABSORBANCE_REQUEST = 1
-ON_REQUEST = 2
-STREAM = 3
-READ_DAQ_DELAY = 4
 
-port = find_arduino()
-arduino = serial.Serial(port, baudrate=115200)
-handshake_arduino(arduino)
+def history_write(buf, start, values):
+    """Write `values` into `buf` starting at index `start`, doubling the
+    capacity of `buf` if it runs out. Returns `buf`, or its grown copy."""
+    stop = start + len(values)
 
-def read_all(ser, read_buffer=b"", **args):
-    """Read all available bytes from the serial port
-    and append to the read buffer.
-
-    Parameters
-    ----------
-    ser : serial.Serial() instance
-        The device we are reading from.
-    read_buffer : bytes, default b''
-        Previous read buffer that is appended to.
-
-    Returns
-    -------
-    output : bytes
-        Bytes object that contains read_buffer + read.
-
-    Notes
-    -----
-    .. `**args` appears, but is never used. This is for
-       compatibility with `read_all_newlines()` as a
-       drop-in replacement for this function.
-    """
-    # Set timeout to None to make sure we read all bytes
-    previous_timeout = ser.timeout
-    ser.timeout = None
-
-    in_waiting = ser.in_waiting
-    read = ser.read(size=in_waiting)
-
-    # Reset to previous timeout
-    ser.timeout = previous_timeout
-
-    return read_buffer + read
-
-
-def read_all_newlines(ser, read_buffer=b"", n_reads=4):
-    """Read data in until encountering newlines.
-
-    Parameters
-    ----------
-    ser : serial.Serial() instance
-        The device we are reading from.
-    n_reads : int
-        The number of reads up to newlines
-    read_buffer : bytes, default b''
-        Previous read buffer that is appended to.
-
-    Returns
-    -------
-    output : bytes
-        Bytes object that contains read_buffer + read.
-
-    Notes
-    -----
-    .. This is a drop-in replacement for read_all().
-    """
-    raw = read_buffer
-    for _ in range(n_reads):
-        raw += ser.read_until()
-
-    return raw
-
-
-def parse_read(read):
-    """Parse a read with time, absorbance data
-
-    Parameters
-    ----------
-    read : byte string
-        Byte string with comma delimited time/absorbance
-        measurements.
-
-    Returns
-    -------
-    time_ms : list of ints
-        Time points in milliseconds.
-    absorbance : list of floats
-        Voltages in volts.
-    remaining_bytes : byte string
-        Remaining, unparsed bytes.
-    """
-    time_ms = []
-    absorbance = []
-
-    # Separate independent time/absorbance measurements
-    pattern = re.compile(b"\d+|,")
-    raw_list = [b"".join(pattern.findall(raw)).decode() for raw in read.split(b"\r\n")]
-
-    for raw in raw_list[:-1]:
-        try:
-            t, A = raw.split(",")
-            time_ms.append(int(t))
-            absorbance.append(float(A) / 1000)
-        except:
-            pass
-
-    if len(raw_list) == 0:
-        return time_ms, absorbance, b""
-    else:
-        return time_ms, absorbance, raw_list[-1].encode()
+    if stop > len(buf):
+        grown = np.empty(max(stop, 2 * len(buf)), dtype=buf.dtype)
+        grown[:start] = buf[:start]
+        buf = grown
+
+    buf[start:stop] = values
+    return buf
 
 
 def parse_raw(raw):
     """Parse bytes output from Arduino."""
-    raw = raw.decode()
-    if raw[-1] != "\n":
+    if not raw.endswith(b"\n"):
         raise ValueError(
             "Input must end with newline, otherwise message is incomplete."
         )
 
-    t, A = raw.rstrip().split(",")
+    # int() and float() take bytes directly, so no need to decode
+    t, _, A = raw.rstrip().partition(b",")
 
     return int(t), float(A)
 
 
-def request_single_absorbance(arduino):
-    """Ask Arduino for a single data point"""
-    # Ask Arduino for data
-    arduino.write(bytes([ABSORBANCE_REQUEST]))
-
-    # Read in the data
-    raw = arduino.read_until()
-
-    # Parse and return
-    return parse_raw(raw)
-
-
 def plot(mode):
     """Build a plot of absorbance vs time data"""
     # Set up plot area
@@ -299,13 +213,18 @@ def layout(p, ctrls):
     )
 
 
-def acquire_callback(arduino, stream_data, source, phantom_source, rollover):
+async def acquire_callback(protocol, stream_data, source, phantom_source, rollover):
     # Pull t and A values from stream or request from Arduino
     if stream_data["mode"] == "stream":
-        t = stream_data["t"][-1]
-        A = stream_data["A"][-1]
+        # Nothing to grab if no data have streamed in yet
+        if stream_data["write_idx"] == 0:
+            return
+
+        i = (stream_data["write_idx"] - 1) % len(stream_data["t"])
+        t = int(stream_data["t"][i])
+        A = float(stream_data["A"][i])
     else:
-        t, A = request_single_absorbance(arduino)
+        t, A = await protocol.request_absorbance()
 
     # Add to on-demand data dictionary
     on_demand_data["t"].append(t)
@@ -319,14 +238,13 @@ def acquire_callback(arduino, stream_data, source, phantom_source, rollover):
     phantom_source.data = new_data
 
 
-def stream_callback(arduino, stream_data, new):
+def stream_callback(protocol, stream_data, new):
     if new:
         stream_data["mode"] = "stream"
+        protocol.start_stream()
     else:
         stream_data["mode"] = "on-demand"
-        arduino.write(bytes([ON_REQUEST]))
-
-    arduino.reset_input_buffer()
+        protocol.stop_stream()
 
 
 def reset_callback(mode, data, source, phantom_source, controls):
@@ -335,8 +253,12 @@ def reset_callback(mode, data, source, phantom_source, controls):
         controls["acquire"].active = False
 
     # Black out the data dictionaries
-    data["t"] = []
-    data["A"] = []
+    if mode == "stream":
+        data["write_idx"] = 0
+        data["read_idx"] = 0
+    else:
+        data["t"] = []
+        data["A"] = []
 
     # Reset the sources
     source.data = dict(t=[], A=[])
@@ -348,8 +270,16 @@ def save_callback(mode, data, controls):
     file_name = controls["file_input"].value  # e.g., "data.csv"
     destination = os.path.join(data_path, file_name)
 
+    # Everything streamed since the last reset
+    if mode == "stream":
+        t = data["t_history"][: data["write_idx"]]
+        A = data["A_history"][: data["write_idx"]]
+    else:
+        t = data["t"]
+        A = data["A"]
+
     # Convert data to a DataFrame and save
-    df = pd.DataFrame(data={"time (ms)": data["t"], "absorbance": data["A"]})
+    df = pd.DataFrame(data={"time (ms)": t, "absorbance": A})
     df.to_csv(destination, index=False)
 
     # Update notice text
@@ -364,40 +294,64 @@ def disable_controls(controls):
         controls[key].disabled = True
 
 
-def shutdown_callback(
-    arduino, daq_task, stream_data, stream_controls, on_demand_controls
-):
+def shutdown_callback(protocol, stream_data, stream_controls, on_demand_controls):
     # Disable controls
     disable_controls(stream_controls)
     disable_controls(on_demand_controls)
 
     # Strop streaming
     stream_data["mode"] = "on-demand"
-    arduino.write(bytes([ON_REQUEST]))
+    protocol.stop_stream()
+
+    # Disconnect from Arduino once pending writes have gone out
+    protocol.transport.close()
+
+
+def stream_update(data, source, phantom_source, rollover, min_batch=8, max_wait=0.2):
+    # Pull out the points that arrived since the last update
+    start, stop = data["read_idx"], data["write_idx"]
 
-    # Stop DAQ async task
-    daq_task.cancel()
+    # Nothing new to plot
+    if stop == start:
+        return
 
-    # Disconnect from Arduino
-    arduino.close()
+    # Hold small batches back until they have waited max_wait seconds
+    now = time.monotonic()
+    if stop - start < min_batch and now - data["last_flush_t"] < max_wait:
+        return
+    data["last_flush_t"] = now
 
+    # Only the last `rollover` points can show up on the plot
+    start = max(start, stop - rollover)
 
-def stream_update(data, source, phantom_source, rollover):
-    # Update plot by streaming in data
-    new_data = {
-        "t": list(np.array(data["t"][data["prev_array_length"] :]) / 1000),
-        "A": data["A"][data["prev_array_length"] :],
-    }
+    # Copy the new points out of the ring buffers, scaling time to seconds
+    # in the same pass
+    t_first, t_second = ring_segments(data["t"], start, stop)
+    A_first, A_second = ring_segments(data["A"], start, stop)
+    n_first = len(t_first)
+
+    t = np.empty(n_first + len(t_second), dtype=np.float64)
+    np.multiply(t_first, 1e-3, out=t[:n_first])
+    np.multiply(t_second, 1e-3, out=t[n_first:])
+    A = np.concatenate((A_first, A_second))
+
+    # Update plot by streaming in data; Bokeh takes the arrays directly
+    new_data = {"t": t, "A": A}
     source.stream(new_data, rollover)
 
-    # Adjust new phantom data point if new data arrived
-    if len(new_data["t"]) > 0:
-        phantom_source.data = dict(t=[new_data["t"][-1]], A=[new_data["A"][-1]])
-    data["prev_array_length"] = len(data["t"])
+    # Adjust new phantom data point
+    phantom_source.data = dict(
+        t=[float(new_data["t"][-1])], A=[float(new_data["A"][-1])]
+    )
+    data["read_idx"] = stop
 
 
 def potentiometer_app(
-    arduino, stream_data, on_demand_data, daq_task, rollover=400, stream_plot_delay=90,
+    protocol,
+    stream_data,
+    on_demand_data,
+    rollover=400,
+    stream_plot_delay=90,
 ):
     def _app(doc):
         # Plots
@@ -426,17 +380,21 @@ def potentiometer_app(
             stream_layout, on_demand_layout, shutdown_layout
         )
 
-        def _acquire_callback(event=None):
-            acquire_callback(
-                arduino,
+        async def _acquire():
+            await acquire_callback(
+                protocol,
                 stream_data,
                 on_demand_source,
                 on_demand_phantom_source,
                 rollover,
             )
 
+        def _acquire_callback(event=None):
+            # Wait on the reply in a coroutine so the event loop keeps running
+            doc.add_next_tick_callback(_acquire)
+
         def _stream_callback(attr, old, new):
-            stream_callback(arduino, stream_data, new)
+            stream_callback(protocol, stream_data, new)
 
         def _stream_reset_callback(event=None):
             reset_callback(
@@ -464,16 +422,19 @@ def potentiometer_app(
 
         def _shutdown_callback(event=None):
             shutdown_callback(
-                arduino, daq_task, stream_data, stream_controls, on_demand_controls
+                protocol, stream_data, stream_controls, on_demand_controls
             )
 
         @bokeh.driving.linear()
         def _stream_update(step):
             stream_update(stream_data, stream_source, stream_phantom_source, rollover)
 
-            # Shut down server if Arduino disconnects (commented out in Jupyter notebook)
-            if not arduino.is_open:
-                sys.exit()
+        def _disconnect_callback():
+            doc.remove_periodic_callback(pc)
+            sys.exit()
+
+        def _connection_lost(exc):
+            doc.add_next_tick_callback(_disconnect_callback)
 
         # Link callbacks
         stream_controls["acquire"].on_change("active", _stream_callback)
@@ -490,67 +451,133 @@ def potentiometer_app(
         # Add a periodic callback, monitor changes in stream data
         pc = doc.add_periodic_callback(_stream_update, stream_plot_delay)
 
+        # Shut down server if Arduino disconnects
+        protocol.on_connection_lost = _connection_lost
+
     return _app
 
 
-async def daq_stream_async(
-    arduino,
-    data,
-    delay=20,
-    n_trash_reads=5,
-    n_reads_per_chunk=4,
-    reader=read_all_newlines,
-):
-    """Obtain streaming data"""
-    # Specify delay
-    arduino.write(bytes([READ_DAQ_DELAY]) + (str(delay) + "x").encode())
+class ArduinoProtocol(asyncio.Protocol):
+    """Parse streaming data into the ring buffers as they arrive
+    over the serial transport."""
 
-    # Current streaming state
-    stream_on = False
+    def __init__(self, data, delay=20, n_trash_reads=5):
+        self.data = data
+        self.delay = delay
+        self.n_trash_reads = n_trash_reads
+        self.transport = None
 
-    # Receive data
-    read_buffer = [b""]
-    while True:
-        if data["mode"] == "stream":
-            # Turn on the stream if need be
-            if not stream_on:
-                arduino.write(bytes([STREAM]))
+        # Called with the exception, if any, once the port has closed
+        self.on_connection_lost = None
 
-                # Read and throw out first few reads
-                i = 0
-                while i < n_trash_reads:
-                    _ = arduino.read_until()
-                    i += 1
+        # Unparsed bytes and number of reads left to throw out
+        self._buf = b""
+        self._n_skip = 0
 
-                stream_on = True
+        # Future for the reply to an on-demand request, if one is pending,
+        # and a lock so that requests go out one at a time
+        self._reply = None
+        self._request_lock = asyncio.Lock()
 
-            # Read in chunk of data
-            raw = reader(arduino, read_buffer=read_buffer[0], n_reads=n_reads_per_chunk)
+    def connection_made(self, transport):
+        self.transport = transport
 
-            # Parse it, passing if it is gibberish
-            try:
-                t, A, read_buffer[0] = parse_read(raw)
+        # Specify delay
+        transport.write(bytes([READ_DAQ_DELAY]) + (str(self.delay) + "x").encode())
 
-                # Update data dictionary
-                data["t"] += t
-                data["A"] += A
-            except:
-                pass
-        else:
-            # Make sure stream is off
-            stream_on = False
+    def connection_lost(self, exc):
+        if self.on_connection_lost is not None:
+            self.on_connection_lost(exc)
 
-        # Sleep 80% of the time before we need to start reading chunks
-        await asyncio.sleep(0.8 * n_reads_per_chunk * delay / 1000)
+    def start_stream(self):
+        """Turn on the stream."""
+        self._buf = b""
+        self._n_skip = self.n_trash_reads
+        self.transport.write(bytes([STREAM]))
+
+    def stop_stream(self):
+        """Turn off the stream."""
+        self.transport.write(bytes([ON_REQUEST]))
+
+    async def request_absorbance(self, timeout=2):
+        """Ask Arduino for a single data point"""
+        # Wait for any earlier request to be answered or time out
+        async with self._request_lock:
+            # Throw out anything left over from streaming
+            self._buf = b""
+            reply = asyncio.get_running_loop().create_future()
+            self._reply = reply
+
+            # Ask Arduino for data, queued behind any earlier writes
+            self.transport.write(bytes([ABSORBANCE_REQUEST]))
+
+            try:
+                return await asyncio.wait_for(reply, timeout)
+            finally:
+                if self._reply is reply:
+                    self._reply = None
+
+    def data_received(self, data):
+        # Outside of streaming, only a reply to a pending request matters;
+        # anything else is left over from the stream
+        if self.data["mode"] != "stream":
+            if self._reply is not None and not self._reply.done():
+                self._reply_received(data)
+            return
+
+        buf = self._buf + data
+
+        # Read and throw out first few reads
+        while self._n_skip > 0:
+            i = buf.find(b"\n")
+            if i < 0:
+                self._buf = buf
+                return
+            buf = buf[i + 1 :]
+            self._n_skip -= 1
+
+        t, A, self._buf = parse_read(buf, counts_per_unit=_ABSORBANCE_COUNTS)
+        if len(t) == 0:
+            return
+
+        # Keep the full record for saving
+        n = self.data["write_idx"]
+        self.data["t_history"] = history_write(self.data["t_history"], n, t)
+        self.data["A_history"] = history_write(self.data["A_history"], n, A)
+
+        # Write into the ring buffers for plotting
+        ring_write(self.data["t"], self.data["write_idx"], t)
+        ring_write(self.data["A"], self.data["write_idx"], A)
+        self.data["write_idx"] += len(t)
+
+    def _reply_received(self, data):
+        """Resolve the pending request once its line is in."""
+        buf = self._buf + data
+        i = buf.find(b"\n")
+        if i < 0:
+            self._buf = buf
+            return
+        self._buf = b""
+
+        try:
+            self._reply.set_result(parse_raw(buf[: i + 1]))
+        except ValueError as e:
+            self._reply.set_exception(e)
 
 
-# Set up asynchronous DAQ task
-daq_task = asyncio.create_task(daq_stream_async(arduino, stream_data))
+# Hand the port over to an asyncio serial transport, which passes
+# streaming data to the protocol as soon as they arrive
+protocol = ArduinoProtocol(stream_data)
+serial_asyncio.SerialTransport(asyncio.get_running_loop(), protocol, arduino)
 
 # Build app
 app = potentiometer_app(
-    arduino, stream_data, on_demand_data, daq_task, rollover=400, stream_plot_delay=90
+    protocol,
+    stream_data,
+    on_demand_data,
+    rollover=rollover,
+    stream_plot_delay=90,
 )
 
 # Build it with curdoc
-app(bokeh.plotting.curdoc())
\ No newline at end of file
+app(bokeh.plotting.curdoc())